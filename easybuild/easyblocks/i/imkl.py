@@ -34,21 +34,64 @@ EasyBuild support for installing the Intel Math Kernel Library (MKL), implemente
 @author: Lumir Jasiok (IT4Innovations)
 """
 
+import errno
 import itertools
 import os
+import re
 import shutil
 import tempfile
+from datetime import datetime
 from distutils.version import LooseVersion
+from multiprocessing.pool import ThreadPool
 
-import easybuild.tools.environment as env
-import easybuild.tools.toolchain as toolchain
 from easybuild.easyblocks.generic.intelbase import IntelBase, ACTIVATION_NAME_2012, LICENSE_FILE_NAME_2012
 from easybuild.framework.easyconfig import CUSTOM
-from easybuild.tools.build_log import EasyBuildError
-from easybuild.tools.filetools import apply_regex_substitutions, change_dir, remove_dir, write_file
+from easybuild.toolchains.mpi.mpich import TC_CONSTANT_MPICH
+from easybuild.toolchains.mpi.mpich2 import TC_CONSTANT_MPICH2
+from easybuild.toolchains.mpi.mvapich2 import TC_CONSTANT_MVAPICH2
+from easybuild.toolchains.mpi.openmpi import TC_CONSTANT_OPENMPI
+from easybuild.tools.build_log import EasyBuildError, time_str_since
+from easybuild.tools.filetools import apply_regex_substitutions, remove_dir, write_file
 from easybuild.tools.modules import get_software_root
-from easybuild.tools.run import run_cmd
+from easybuild.tools.py2vs3 import subprocess_popen_text
+from easybuild.tools.run import parse_cmd_output
 from easybuild.tools.systemtools import get_shared_lib_ext
+from easybuild.tools.utilities import trace_msg
+
+
+# versions of imkl which are relevant to the installation procedure
+V_10_3 = LooseVersion('10.3')
+V_10_3_4 = LooseVersion('10.3.4')
+V_11 = LooseVersion('11')
+V_11_0 = LooseVersion('11.0')
+V_11_0_2 = LooseVersion('11.0.2')
+V_11_1 = LooseVersion('11.1')
+V_11_3 = LooseVersion('11.3')
+V_2017_0_0 = LooseVersion('2017.0.0')
+V_2017_2_174 = LooseVersion('2017.2.174')
+V_2021 = LooseVersion('2021')
+
+# MPI specification to use for building cdft wrappers, by MPI family
+MPI_SPEC_BY_FAM = {
+    TC_CONSTANT_MPICH: 'mpich2',  # MPICH is MPICH v3.x, which is MPICH2 compatible
+    TC_CONSTANT_MPICH2: 'mpich2',
+    TC_CONSTANT_MVAPICH2: 'mpich2',
+    TC_CONSTANT_OPENMPI: 'openmpi',
+}
+
+# regex substitutions to apply to makefiles of cdft wrappers when PGI is used as compiler
+PGI_CDFT_MAKEFILE_REGEX_SUBS = [(re.compile(regex), subtxt) for (regex, subtxt) in [
+    # pgi should be considered as a valid compiler
+    ("intel gnu", "intel gnu pgi"),
+    # transform 'gnu' case to 'pgi' case
+    (r"ifeq \(\$\(compiler\),gnu\)", "ifeq ($(compiler),pgi)"),
+    ('=gcc', '=pgcc'),
+    # correct flag to use C99 standard
+    ('-std=c99', '-c99'),
+    # -Wall and -Werror are not valid options for pgcc, no close equivalent
+    ('-Wall', ''),
+    ('-Werror', ''),
+]]
 
 
 class EB_imkl(IntelBase):
@@ -63,6 +106,8 @@ class EB_imkl(IntelBase):
         """Add easyconfig parameters custom to imkl (e.g. interfaces)."""
         extra_vars = {
             'interfaces': [True, "Indicates whether interfaces should be built", CUSTOM],
+            'skip_existing_interfaces': [False, "Skip building variants of interface libraries that are already "
+                                                "installed and more recent than the interface makefile", CUSTOM],
         }
         return IntelBase.extra_options(extra_vars)
 
@@ -72,9 +117,12 @@ class EB_imkl(IntelBase):
         self.cfg.update('unwanted_env_vars', ['MKLROOT'])
         self.cdftlibs = []
         self.mpi_spec = None
+        self.interfaces_comp_fam = None
+        self.loosever = LooseVersion(self.version)
+        self.shlib_ext = get_shared_lib_ext()
 
     def prepare_step(self, *args, **kwargs):
-        if LooseVersion(self.version) >= LooseVersion('2017.2.174'):
+        if self.loosever >= V_2017_2_174:
             kwargs['requires_runtime_license'] = False
             super(EB_imkl, self).prepare_step(*args, **kwargs)
         else:
@@ -83,18 +131,12 @@ class EB_imkl(IntelBase):
         # build the mkl interfaces, if desired
         if self.cfg['interfaces']:
             self.cdftlibs = ['fftw2x_cdft']
-            if LooseVersion(self.version) >= LooseVersion('10.3'):
+            if self.loosever >= V_10_3:
                 self.cdftlibs.append('fftw3x_cdft')
             # check whether MPI_FAMILY constant is defined, so mpi_family() can be used
             if hasattr(self.toolchain, 'MPI_FAMILY') and self.toolchain.MPI_FAMILY is not None:
-                mpi_spec_by_fam = {
-                    toolchain.MPICH: 'mpich2',  # MPICH is MPICH v3.x, which is MPICH2 compatible
-                    toolchain.MPICH2: 'mpich2',
-                    toolchain.MVAPICH2: 'mpich2',
-                    toolchain.OPENMPI: 'openmpi',
-                }
                 mpi_fam = self.toolchain.mpi_family()
-                self.mpi_spec = mpi_spec_by_fam.get(mpi_fam)
+                self.mpi_spec = MPI_SPEC_BY_FAM.get(mpi_fam)
                 debugstr = "MPI toolchain component"
             else:
                 # can't use toolchain.mpi_family, because of system toolchain
@@ -111,6 +153,26 @@ class EB_imkl(IntelBase):
             else:
                 self.log.debug("No MPI or no compatible MPI found: do not build CDFT")
 
+    def get_interfaces_comp_fam(self):
+        """
+        Determine compiler family to use for the MKL interfaces: 'intel', 'pgi' or 'gnu'.
+        The loaded compiler modules are only checked once.
+        """
+        if self.interfaces_comp_fam is None:
+            # determine whether we're using a non-Intel GCC-based or PGI-based toolchain
+            # can't use toolchain.comp_family, because of system toolchain used when installing imkl
+            if get_software_root('icc') or get_software_root('intel-compilers'):
+                self.interfaces_comp_fam = 'intel'
+            # check for PGI first, since there's a GCC underneath PGI too...
+            elif get_software_root('PGI'):
+                self.interfaces_comp_fam = 'pgi'
+            elif get_software_root('GCC'):
+                self.interfaces_comp_fam = 'gnu'
+            else:
+                raise EasyBuildError("Not using Intel/GCC/PGI compilers, don't know how to build wrapper libs")
+
+        return self.interfaces_comp_fam
+
     def install_step(self):
         """
         Actual installation
@@ -120,7 +182,7 @@ class EB_imkl(IntelBase):
         silent_cfg_names_map = None
         silent_cfg_extras = None
 
-        if LooseVersion(self.version) < LooseVersion('11.1'):
+        if self.loosever < V_11_1:
             # since imkl v11.1, silent.cfg has been slightly changed to be 'more standard'
 
             silent_cfg_names_map = {
@@ -128,7 +190,7 @@ class EB_imkl(IntelBase):
                 'license_file_name': LICENSE_FILE_NAME_2012,
             }
 
-        if LooseVersion(self.version) >= LooseVersion('11.1') and self.install_components is None:
+        if self.loosever >= V_11_1 and self.install_components is None:
             silent_cfg_extras = {
                 'COMPONENTS': 'ALL',
             }
@@ -143,11 +205,11 @@ class EB_imkl(IntelBase):
         """
         guesses = super(EB_imkl, self).make_module_req_guess()
 
-        if LooseVersion(self.version) >= LooseVersion('10.3'):
+        if self.loosever >= V_10_3:
             if self.cfg['m32']:
                 raise EasyBuildError("32-bit not supported yet for IMKL v%s (>= 10.3)", self.version)
             else:
-                if LooseVersion(self.version) >= LooseVersion('2021'):
+                if self.loosever >= V_2021:
                     compiler_subdir = os.path.join('compiler', self.version, 'linux', 'compiler', 'lib', 'intel64_lin')
                     mkl_subdir = os.path.join('mkl', self.version)
                     pkg_config_path = [os.path.join(mkl_subdir, 'tools', 'pkgconfig')]
@@ -156,10 +218,10 @@ class EB_imkl(IntelBase):
                     mkl_subdir = 'mkl'
                     pkg_config_path = [os.path.join(mkl_subdir, 'bin', 'pkgconfig')]
                     guesses['MANPATH'] = ['man', 'man/en_US']
-                    if LooseVersion(self.version) >= LooseVersion('11.0'):
-                        if LooseVersion(self.version) >= LooseVersion('11.3'):
+                    if self.loosever >= V_11_0:
+                        if self.loosever >= V_11_3:
                             guesses['MIC_LD_LIBRARY_PATH'] = ['lib/intel64_lin_mic', 'mkl/lib/mic']
-                        elif LooseVersion(self.version) >= LooseVersion('11.1'):
+                        elif self.loosever >= V_11_1:
                             guesses['MIC_LD_LIBRARY_PATH'] = ['lib/mic', 'mkl/lib/mic']
                         else:
                             guesses['MIC_LD_LIBRARY_PATH'] = ['compiler/lib/mic', 'mkl/lib/mic']
@@ -194,7 +256,7 @@ class EB_imkl(IntelBase):
         """Overwritten from Application to add extra txt"""
         txt = super(EB_imkl, self).make_module_extra()
 
-        if LooseVersion(self.version) >= LooseVersion('2021'):
+        if self.loosever >= V_2021:
             mklroot = os.path.join(self.installdir, 'mkl', self.version)
         else:
             mklroot = os.path.join(self.installdir, 'mkl')
@@ -208,14 +270,12 @@ class EB_imkl(IntelBase):
         """
         super(EB_imkl, self).post_install_step()
 
-        shlib_ext = get_shared_lib_ext()
-
         # reload the dependencies
         self.load_dependency_modules()
 
         if self.cfg['m32']:
             extra = {
-                'libmkl.%s' % shlib_ext: 'GROUP (-lmkl_intel -lmkl_intel_thread -lmkl_core)',
+                'libmkl.%s' % self.shlib_ext: 'GROUP (-lmkl_intel -lmkl_intel_thread -lmkl_core)',
                 'libmkl_em64t.a': 'GROUP (libmkl_intel.a libmkl_intel_thread.a libmkl_core.a)',
                 'libmkl_solver.a': 'GROUP (libmkl_solver.a)',
                 'libmkl_scalapack.a': 'GROUP (libmkl_scalapack_core.a)',
@@ -224,7 +284,7 @@ class EB_imkl(IntelBase):
             }
         else:
             extra = {
-                'libmkl.%s' % shlib_ext: 'GROUP (-lmkl_intel_lp64 -lmkl_intel_thread -lmkl_core)',
+                'libmkl.%s' % self.shlib_ext: 'GROUP (-lmkl_intel_lp64 -lmkl_intel_thread -lmkl_core)',
                 'libmkl_em64t.a': 'GROUP (libmkl_intel_lp64.a libmkl_intel_thread.a libmkl_core.a)',
                 'libmkl_solver.a': 'GROUP (libmkl_solver_lp64.a)',
                 'libmkl_scalapack.a': 'GROUP (libmkl_scalapack_lp64.a)',
@@ -232,11 +292,9 @@ class EB_imkl(IntelBase):
                 'libmkl_cdft.a': 'GROUP (libmkl_cdft_core.a)'
             }
 
-        loosever = LooseVersion(self.version)
-
-        if loosever >= LooseVersion('2021'):
+        if self.loosever >= V_2021:
             libsubdir = os.path.join('mkl', self.version, 'lib', 'intel64')
-        elif loosever >= LooseVersion('10.3'):
+        elif self.loosever >= V_10_3:
             libsubdir = os.path.join('mkl', 'lib', 'intel64')
         else:
             if self.cfg['m32']:
@@ -244,18 +302,26 @@ class EB_imkl(IntelBase):
             else:
                 libsubdir = os.path.join('lib', 'em64t')
 
-        for fil, txt in extra.items():
-            dest = os.path.join(self.installdir, libsubdir, fil)
-            if not os.path.exists(dest):
-                write_file(dest, txt)
+        # only create linker scripts that are not there yet (checked via a single directory listing);
+        # any kind of directory entry counts as present, to avoid overwriting actual libraries or writing via symlinks
+        libdir = os.path.join(self.installdir, libsubdir)
+        try:
+            present = set(os.listdir(libdir))
+        except OSError as err:
+            self.log.debug("Failed to list contents of %s: %s", libdir, err)
+            present = set()
+
+        for fil in sorted(extra):
+            if fil not in present:
+                write_file(os.path.join(libdir, fil), extra[fil])
 
         # build the mkl interfaces, if desired
         if self.cfg['interfaces']:
 
-            if loosever >= LooseVersion('2021'):
+            if self.loosever >= V_2021:
                 intsubdir = os.path.join('mkl', self.version, 'interfaces')
                 inttarget = 'libintel64'
-            elif loosever >= LooseVersion('10.3'):
+            elif self.loosever >= V_10_3:
                 intsubdir = os.path.join('mkl', 'interfaces')
                 inttarget = 'libintel64'
             else:
@@ -265,201 +331,295 @@ class EB_imkl(IntelBase):
                 else:
                     inttarget = 'libem64t'
 
-            cmd = "make -f makefile %s" % inttarget
+            interfacedir = os.path.join(self.installdir, intsubdir)
+            if not os.path.isdir(interfacedir):
+                raise EasyBuildError("Interfaces directory %s not found", interfacedir)
 
-            # blas95 and lapack95 need more work, ignore for now
-            # blas95 and lapack also need include/.mod to be processed
-            fftw2libs = ['fftw2xc', 'fftw2xf']
-            fftw3libs = ['fftw3xc', 'fftw3xf']
+            # patch makefiles for cdft wrappers when PGI is used as compiler
+            if self.get_interfaces_comp_fam() == 'pgi':
+                makefiles = [os.path.join(interfacedir, lib, 'makefile') for lib in self.cdftlibs]
+                apply_regex_substitutions(makefiles, PGI_CDFT_MAKEFILE_REGEX_SUBS)
+
+            interface_builds = self.get_interface_builds()
+
+            # different interface libraries are built in parallel, since they are built in separate directories;
+            # variants of the same interface library are built one after the other in a single worker
+            workers = max(1, min(self.cfg['parallel'] or 1, len(interface_builds)))
+            variant_cnt = sum(len(variants) for (_, _, variants) in interface_builds)
+            self.log.info("Building %d variants of %d MKL interface libraries using %d workers",
+                          variant_cnt, len(interface_builds), workers)
+
+            # let make use the cores that are available to each worker
+            make_jobs = max(1, (self.cfg['parallel'] or 1) // workers)
+            cmd = "make -j %d -f makefile %s" % (make_jobs, inttarget)
+
+            pool = ThreadPool(workers)
+            try:
+                pool.map(lambda args: self.build_interface_lib(interfacedir, cmd, libdir, *args), interface_builds)
+            finally:
+                pool.close()
+                pool.join()
+
+    def get_interface_builds(self):
+        """
+        Determine which MKL interface libraries should be built, with which build options and variants.
+        Returns list of (lib, buildopts, variants) tuples; each variant is a (flags, intflag, precflag) tuple.
+        """
+        # blas95 and lapack95 need more work, ignore for now
+        # blas95 and lapack also need include/.mod to be processed
+        fftw2libs = ['fftw2xc', 'fftw2xf']
+        fftw3libs = ['fftw3xc', 'fftw3xf']
 
-            interfacedir = os.path.join(self.installdir, intsubdir)
-            change_dir(interfacedir)
-            self.log.info("Changed to interfaces directory %s", interfacedir)
+        compopt = 'compiler=%s' % self.get_interfaces_comp_fam()
 
-            compopt = None
-            # determine whether we're using a non-Intel GCC-based or PGI-based toolchain
-            # can't use toolchain.comp_family, because of system toolchain used when installing imkl
-            if get_software_root('icc') or get_software_root('intel-compilers'):
-                compopt = 'compiler=intel'
-            else:
-                # check for PGI first, since there's a GCC underneath PGI too...
-                if get_software_root('PGI'):
-                    compopt = 'compiler=pgi'
-                elif get_software_root('GCC'):
-                    compopt = 'compiler=gnu'
-                else:
-                    raise EasyBuildError("Not using Intel/GCC/PGI compilers, don't know how to build wrapper libs")
+        interface_builds = []
+        for lib in fftw2libs + fftw3libs + self.cdftlibs:
+            buildopts = [compopt]
+            if lib in fftw3libs:
+                buildopts.append('install_to=$INSTALL_DIR')
+            elif lib in self.cdftlibs:
+                if self.mpi_spec is not None:
+                    buildopts.append('mpi=%s' % self.mpi_spec)
 
-            # patch makefiles for cdft wrappers when PGI is used as compiler
-            if get_software_root('PGI'):
-                regex_subs = [
-                    # pgi should be considered as a valid compiler
-                    ("intel gnu", "intel gnu pgi"),
-                    # transform 'gnu' case to 'pgi' case
-                    (r"ifeq \(\$\(compiler\),gnu\)", "ifeq ($(compiler),pgi)"),
-                    ('=gcc', '=pgcc'),
-                    # correct flag to use C99 standard
-                    ('-std=c99', '-c99'),
-                    # -Wall and -Werror are not valid options for pgcc, no close equivalent
-                    ('-Wall', ''),
-                    ('-Werror', ''),
-                ]
-                for lib in self.cdftlibs:
-                    apply_regex_substitutions(os.path.join(interfacedir, lib, 'makefile'), regex_subs)
-
-            for lib in fftw2libs + fftw3libs + self.cdftlibs:
-                buildopts = [compopt]
-                if lib in fftw3libs:
-                    buildopts.append('install_to=$INSTALL_DIR')
-                elif lib in self.cdftlibs:
-                    if self.mpi_spec is not None:
-                        buildopts.append('mpi=%s' % self.mpi_spec)
-
-                precflags = ['']
-                if lib.startswith('fftw2x') and not self.cfg['m32']:
-                    # build both single and double precision variants
-                    precflags = ['PRECISION=MKL_DOUBLE', 'PRECISION=MKL_SINGLE']
-
-                intflags = ['']
-                if lib in self.cdftlibs and not self.cfg['m32']:
-                    # build both 32-bit and 64-bit interfaces
-                    intflags = ['interface=lp64', 'interface=ilp64']
-
-                allopts = [list(opts) for opts in itertools.product(intflags, precflags)]
-
-                for flags, extraopts in itertools.product(['', '-fPIC'], allopts):
-                    tup = (lib, flags, buildopts, extraopts)
-                    self.log.debug("Building lib %s with: flags %s, buildopts %s, extraopts %s" % tup)
-
-                    tmpbuild = tempfile.mkdtemp(dir=self.builddir)
-                    self.log.debug("Created temporary directory %s" % tmpbuild)
-
-                    # always set INSTALL_DIR, SPEC_OPT, COPTS and CFLAGS
-                    # fftw2x(c|f): use $INSTALL_DIR, $CFLAGS and $COPTS
-                    # fftw3x(c|f): use $CFLAGS
-                    # fftw*cdft: use $INSTALL_DIR and $SPEC_OPT
-                    env.setvar('INSTALL_DIR', tmpbuild)
-                    env.setvar('SPEC_OPT', flags)
-                    env.setvar('COPTS', flags)
-                    env.setvar('CFLAGS', flags)
-
-                    try:
-                        intdir = os.path.join(interfacedir, lib)
-                        os.chdir(intdir)
-                        self.log.info("Changed to interface %s directory %s" % (lib, intdir))
-                    except OSError as err:
-                        raise EasyBuildError("Can't change to interface %s directory %s: %s", lib, intdir, err)
-
-                    fullcmd = "%s %s" % (cmd, ' '.join(buildopts + extraopts))
-                    res = run_cmd(fullcmd, log_all=True, simple=True)
-                    if not res:
-                        raise EasyBuildError("Building %s (flags: %s, fullcmd: %s) failed", lib, flags, fullcmd)
-
-                    for fn in os.listdir(tmpbuild):
-                        src = os.path.join(tmpbuild, fn)
-                        if flags == '-fPIC':
-                            # add _pic to filename
-                            ff = fn.split('.')
-                            fn = '.'.join(ff[:-1]) + '_pic.' + ff[-1]
-                        dest = os.path.join(self.installdir, libsubdir, fn)
+            precflags = ['']
+            if lib.startswith('fftw2x') and not self.cfg['m32']:
+                # build both single and double precision variants
+                precflags = ['PRECISION=MKL_DOUBLE', 'PRECISION=MKL_SINGLE']
+
+            intflags = ['']
+            if lib in self.cdftlibs and not self.cfg['m32']:
+                # build both 32-bit and 64-bit interfaces
+                intflags = ['interface=lp64', 'interface=ilp64']
+
+            variants = list(itertools.product(['', '-fPIC'], intflags, precflags))
+
+            interface_builds.append((lib, buildopts, variants))
+
+        return interface_builds
+
+    def interface_lib_name(self, lib, flags, intflag, precflag):
+        """
+        Determine name of MKL interface library that gets installed for a particular variant.
+        """
+        name = 'lib' + lib
+
+        if lib in self.cdftlibs:
+            if lib.startswith('fftw2x'):
+                name += '_SINGLE' if precflag == 'PRECISION=MKL_SINGLE' else '_DOUBLE'
+            if self.loosever >= V_11_0_2:
+                name += '_' + (intflag.split('=')[-1] or 'lp64')
+        else:
+            if lib.startswith('fftw2x') and self.loosever >= V_11:
+                name += '_single' if precflag == 'PRECISION=MKL_SINGLE' else '_double'
+            name += '_' + self.get_interfaces_comp_fam()
+
+        if flags == '-fPIC':
+            name += '_pic'
+
+        return name + '.a'
+
+    def build_interface_lib(self, interfacedir, cmd, libdir, lib, buildopts, variants):
+        """
+        Build all specified variants of a particular MKL interface library, and move them to the library directory.
+        """
+        intdir = os.path.join(interfacedir, lib)
+
+        # same temporary directory is used for all variants, since built libraries are moved out after each build
+        tmpbuild = tempfile.mkdtemp(dir=self.builddir, prefix='imkl-%s-' % lib)
+        self.log.debug("Created temporary directory %s" % tmpbuild)
+
+        # always set INSTALL_DIR, SPEC_OPT, COPTS and CFLAGS
+        # fftw2x(c|f): use $INSTALL_DIR, $CFLAGS and $COPTS
+        # fftw3x(c|f): use $CFLAGS
+        # fftw*cdft: use $INSTALL_DIR and $SPEC_OPT
+        # these are only set in the environment of the build commands (not via env.setvar),
+        # since os.environ is shared by all workers and changes to it would leak into subsequent steps
+        build_env = os.environ.copy()
+        build_env['INSTALL_DIR'] = tmpbuild
+
+        makefile_mtime = None
+        if self.cfg['skip_existing_interfaces']:
+            makefile = os.path.join(intdir, 'makefile')
+            try:
+                makefile_mtime = os.path.getmtime(makefile)
+            except OSError as err:
+                # don't skip anything, building will fail with a clear error if the makefile is really missing
+                self.log.info("Failed to determine modification time of %s, so not skipping any builds: %s",
+                              makefile, err)
+
+        for flags, intflag, precflag in variants:
+            if makefile_mtime is not None:
+                lib_path = os.path.join(libdir, self.interface_lib_name(lib, flags, intflag, precflag))
+                if os.path.isfile(lib_path) and os.path.getmtime(lib_path) >= makefile_mtime:
+                    self.log.info("Not building %s again, since %s is already installed", lib, lib_path)
+                    continue
+
+            extraopts = [intflag, precflag]
+            tup = (lib, flags, buildopts, extraopts)
+            self.log.debug("Building lib %s with: flags %s, buildopts %s, extraopts %s" % tup)
+
+            build_env.update({
+                'SPEC_OPT': flags,
+                'COPTS': flags,
+                'CFLAGS': flags,
+            })
+
+            fullcmd = "%s %s" % (cmd, ' '.join(buildopts + extraopts))
+            self.log.info("Running command '%s' in %s", fullcmd, intdir)
+
+            # run_cmd can't be used here, since it has no way to specify the working directory or environment
+            # for a single command (other than changing the process-wide working directory or os.environ,
+            # which are shared by all workers), so the command is run via Popen (with cwd and env) instead
+            start_time = datetime.now()
+            trace_msg("running command:\n\t[started at: %s]\n\t[working dir: %s]\n\t%s" %
+                      (start_time.strftime('%Y-%m-%d %H:%M:%S'), intdir, fullcmd))
+            try:
+                proc = subprocess_popen_text(fullcmd, shell=True, cwd=intdir, env=build_env)
+            except OSError as err:
+                raise EasyBuildError("Failed to run '%s' in interface %s directory %s: %s", fullcmd, lib, intdir, err)
+            (stdout, stderr) = proc.communicate()
+            trace_msg("command completed: exit %s, ran in %s" % (proc.returncode, time_str_since(start_time)))
+
+            # check exit code and scan output for error patterns (taking into account --strict),
+            # exactly like run_cmd(..., log_all=True, simple=True) does
+            parse_cmd_output(fullcmd, stdout + stderr, proc.returncode, True, True, True, True)
+
+            for fn in os.listdir(tmpbuild):
+                src = os.path.join(tmpbuild, fn)
+                if flags == '-fPIC':
+                    # add _pic to filename
+                    ff = fn.split('.')
+                    fn = '.'.join(ff[:-1]) + '_pic.' + ff[-1]
+                dest = os.path.join(libdir, fn)
+                try:
+                    if os.path.isfile(src):
+                        # temporary build directory is usually on the same filesystem as the installation,
+                        # so just renaming is sufficient (which avoids the extra checks done by shutil.move)
                         try:
-                            if os.path.isfile(src):
-                                shutil.move(src, dest)
-                                self.log.info("Moved %s to %s" % (src, dest))
+                            os.rename(src, dest)
                         except OSError as err:
-                            raise EasyBuildError("Failed to move %s to %s: %s", src, dest, err)
+                            if err.errno != errno.EXDEV:
+                                raise
+                            shutil.move(src, dest)
+                        self.log.info("Moved %s to %s" % (src, dest))
+                except OSError as err:
+                    raise EasyBuildError("Failed to move %s to %s: %s", src, dest, err)
+
+        remove_dir(tmpbuild)
 
-                    remove_dir(tmpbuild)
+    def filter_listed_files(self, paths):
+        """
+        Filter out files (relative to installation directory) that are listed as regular files
+        in the directory they are located in.
+
+        This requires only a single directory listing per directory, rather than checking each file separately,
+        which makes a big difference on a networked filesystem when checking for lots of files in a few directories.
+
+        Only regular files are filtered out: symbolic links (which may be dangling) and directories are retained,
+        so they are still checked individually.
+        """
+        # os.scandir is required to determine the type of directory entries without an additional stat call;
+        # it is not available in Python 2, so just retain all files there
+        if not hasattr(os, 'scandir'):
+            return paths
+
+        listed = {}
+        for subdir in sorted(set(os.path.dirname(path) for path in paths)):
+            try:
+                entries = list(os.scandir(os.path.join(self.installdir, subdir)))
+            except OSError as err:
+                self.log.debug("Failed to list contents of %s: %s", subdir, err)
+                entries = []
+            listed[subdir] = set(entry.name for entry in entries if entry.is_file(follow_symlinks=False))
+
+        return [path for path in paths if os.path.basename(path) not in listed[os.path.dirname(path)]]
 
     def sanity_check_step(self):
         """Custom sanity check paths for Intel MKL."""
-        shlib_ext = get_shared_lib_ext()
-
-        mklfiles = None
-        mkldirs = None
-        ver = LooseVersion(self.version)
-        libs = ['libmkl_core.%s' % shlib_ext, 'libmkl_gnu_thread.%s' % shlib_ext,
-                'libmkl_intel_thread.%s' % shlib_ext, 'libmkl_sequential.%s' % shlib_ext]
-        extralibs = ['libmkl_blacs_intelmpi_%(suff)s.' + shlib_ext, 'libmkl_scalapack_%(suff)s.' + shlib_ext]
+        libs = ['libmkl_%s.%s' % (x, self.shlib_ext) for x in ['core', 'gnu_thread', 'intel_thread', 'sequential']]
 
         if self.cfg['interfaces']:
-            if get_software_root('icc') or get_software_root('intel-compilers'):
-                compsuff = '_intel'
-            # check for PGI first, since there's a GCC underneath PGI too...
-            elif get_software_root('PGI'):
-                compsuff = '_pgi'
-            elif get_software_root('GCC'):
-                compsuff = '_gnu'
-            else:
-                raise EasyBuildError("Not using Intel/GCC/PGI, don't know compiler suffix for FFTW libraries.")
+            compsuff = '_%s' % self.get_interfaces_comp_fam()
 
             precs = ['_double', '_single']
-            if ver < LooseVersion('11'):
+            if self.loosever < V_11:
                 # no precision suffix in libfftw2 libs before imkl v11
                 precs = ['']
             fftw_vers = ['2x%s%s' % (x, prec) for x in ['c', 'f'] for prec in precs] + ['3xc', '3xf']
             pics = ['', '_pic']
-            libs += ['libfftw%s%s%s.a' % (fftwver, compsuff, pic) for fftwver in fftw_vers for pic in pics]
+            libs.extend('libfftw%s%s%s.a' % (fftwver, compsuff, pic) for fftwver in fftw_vers for pic in pics)
 
             if self.cdftlibs:
                 fftw_cdft_vers = ['2x_cdft_DOUBLE']
                 if not self.cfg['m32']:
                     fftw_cdft_vers.append('2x_cdft_SINGLE')
-                if ver >= LooseVersion('10.3'):
+                if self.loosever >= V_10_3:
                     fftw_cdft_vers.append('3x_cdft')
-                if ver >= LooseVersion('11.0.2'):
+                if self.loosever >= V_11_0_2:
                     bits = ['_lp64']
                     if not self.cfg['m32']:
                         bits.append('_ilp64')
                 else:
                     # no bits suffix in cdft libs before imkl v11.0.2
                     bits = ['']
-                libs += ['libfftw%s%s%s.a' % x for x in itertools.product(fftw_cdft_vers, bits, pics)]
+                cdft_vars = itertools.product(fftw_cdft_vers, bits, pics)
+                libs.extend('libfftw%s%s%s.a' % (fftwver, bit, pic) for (fftwver, bit, pic) in cdft_vars)
 
-        if ver >= LooseVersion('10.3') and self.cfg['m32']:
+        if self.loosever >= V_10_3 and self.cfg['m32']:
             raise EasyBuildError("Sanity check for 32-bit not implemented yet for IMKL v%s (>= 10.3)", self.version)
 
-        if ver >= LooseVersion('2021'):
+        if not self.cfg['m32']:
+            extralibs = ['blacs_intelmpi', 'scalapack']
+            libs.extend('libmkl_%s_%s.%s' % (x, suff, self.shlib_ext) for x in extralibs for suff in ['lp64', 'ilp64'])
+
+        if self.loosever >= V_2021:
             basedir = os.path.join('mkl', self.version)
+            libdir = os.path.join(basedir, 'lib', 'intel64')
 
             mkldirs = [
                 os.path.join(basedir, 'bin'),
-                os.path.join(basedir, 'lib', 'intel64'),
+                libdir,
                 os.path.join(basedir, 'include'),
             ]
-            libs += [lib % {'suff': suff} for lib in extralibs for suff in ['lp64', 'ilp64']]
 
             mklfiles = [
-                os.path.join(basedir, 'lib', 'intel64', 'libmkl_core.%s' % shlib_ext),
+                os.path.join(libdir, 'libmkl_core.%s' % self.shlib_ext),
                 os.path.join(basedir, 'include', 'mkl.h'),
             ]
-            mklfiles.extend([os.path.join(basedir, 'lib', 'intel64', lib) for lib in libs])
 
-        elif ver >= LooseVersion('10.3'):
-            mkldirs = ['bin', 'mkl/bin', 'mkl/lib/intel64', 'mkl/include']
-            if ver < LooseVersion('11.3'):
+        elif self.loosever >= V_10_3:
+            libdir = 'mkl/lib/intel64'
+            mkldirs = ['bin', 'mkl/bin', libdir, 'mkl/include']
+            if self.loosever < V_11_3:
                 mkldirs.append('mkl/bin/intel64')
-            libs += [lib % {'suff': suff} for lib in extralibs for suff in ['lp64', 'ilp64']]
-            mklfiles = ['mkl/lib/intel64/libmkl.%s' % shlib_ext, 'mkl/include/mkl.h'] + \
-                       ['mkl/lib/intel64/%s' % lib for lib in libs]
-            if ver >= LooseVersion('10.3.4') and ver < LooseVersion('11.1'):
+            mklfiles = ['%s/libmkl.%s' % (libdir, self.shlib_ext), 'mkl/include/mkl.h']
+            if self.loosever >= V_10_3_4 and self.loosever < V_11_1:
                 mkldirs += ['compiler/lib/intel64']
             else:
-                if ver >= LooseVersion('2017.0.0'):
+                if self.loosever >= V_2017_0_0:
                     mkldirs += ['lib/intel64_lin']
                 else:
                     mkldirs += ['lib/intel64']
 
         else:
             if self.cfg['m32']:
-                mklfiles = ['lib/32/libmkl.%s' % shlib_ext, 'include/mkl.h'] + \
-                           ['lib/32/%s' % lib for lib in libs]
-                mkldirs = ['lib/32', 'include/32', 'interfaces']
+                libdir = 'lib/32'
+                mkldirs = [libdir, 'include/32', 'interfaces']
             else:
-                libs += [lib % {'suff': suff} for lib in extralibs for suff in ['lp64', 'ilp64']]
-                mklfiles = ['lib/em64t/libmkl.%s' % shlib_ext, 'include/mkl.h'] + \
-                           ['lib/em64t/%s' % lib for lib in libs]
-                mkldirs = ['lib/em64t', 'include/em64t', 'interfaces']
+                libdir = 'lib/em64t'
+                mkldirs = [libdir, 'include/em64t', 'interfaces']
+            mklfiles = ['%s/libmkl.%s' % (libdir, self.shlib_ext), 'include/mkl.h']
+
+        mklfiles.extend(os.path.join(libdir, lib) for lib in libs)
+
+        # group files per directory (stable sort, so order of files within a directory is retained),
+        # so that files in the same directory are checked one after the other
+        mklfiles.sort(key=os.path.dirname)
+
+        # only pass down files that are not found in the listing of their directory,
+        # so any missing files are still reported as usual
+        if not self.dry_run:
+            mklfiles = self.filter_listed_files(mklfiles)
 
         custom_paths = {
             'files': mklfiles,
@@ -34,19 +34,56 @@ EasyBuild support for installing the Intel MPI library, implemented as an easybl
 @author: Alex Domingo (Vrije Universiteit Brussel)
 """
 import os
+import re
 from distutils.version import LooseVersion
 
 import easybuild.tools.toolchain as toolchain
 from easybuild.easyblocks.generic.intelbase import IntelBase, ACTIVATION_NAME_2012, LICENSE_FILE_NAME_2012
 from easybuild.framework.easyconfig import CUSTOM
 from easybuild.tools.build_log import EasyBuildError
-from easybuild.tools.filetools import apply_regex_substitutions, change_dir, extract_file, mkdir, write_file
+from easybuild.tools.filetools import apply_regex_substitutions, change_dir, copy_file, extract_file
+from easybuild.tools.filetools import mkdir, read_file, which, write_file
 from easybuild.tools.modules import get_software_root
 from easybuild.tools.run import run_cmd
 from easybuild.tools.systemtools import get_shared_lib_ext
 from easybuild.tools.toolchain.mpi import get_mpi_cmd_template
 
 
+# versions of impi which are relevant to the installation procedure
+V_4_0 = LooseVersion('4.0')
+V_4_0_1 = LooseVersion('4.0.1')
+V_4_1_1 = LooseVersion('4.1.1')
+V_4_1_1_036 = LooseVersion('4.1.1.036')
+V_5_0_1_035 = LooseVersion('5.0.1.035')
+V_2017 = LooseVersion('2017')
+V_2017_2_174 = LooseVersion('2017.2.174')
+V_2018_0_128 = LooseVersion('2018.0.128')
+V_2019 = LooseVersion('2019')
+V_2021 = LooseVersion('2021')
+
+# patterns for lines in env scripts and compiler wrappers that specify the installation prefix of impi,
+# which need to be fixed after moving the installed files (applied line per line, see apply_regex_substitutions)
+MPIVARS_CSH_I_MPI_ROOT_REGEX = re.compile(r"^setenv I_MPI_ROOT.*")
+MPIVARS_SH_I_MPI_ROOT_REGEX = re.compile(r"^(\s*)I_MPI_ROOT=[^;\n]*")
+WRAPPER_PREFIX_REGEX = re.compile(r"^prefix=.*")
+
+# compiler wrapper scripts that specify the installation prefix of impi
+COMPILER_WRAPPERS = ['mpif77', 'mpif90', 'mpigcc', 'mpigxx', 'mpiicc', 'mpiicpc', 'mpiifort']
+
+# template for a section of the silent.cfg file used to install impi versions prior to 4.0.1;
+# same settings are used for both 'mpi' and 'mpi-rt' sections
+SILENT_CFG_SECTION_TEMPLATE = """[%(section)s]
+INSTALLDIR=%(ins)s
+LICENSEPATH=%(lic)s
+INSTALLMODE=NONRPM
+INSTALLUSER=NONROOT
+UPDATE_LD_SO_CONF=NO
+PROCEED_WITHOUT_PYTHON=yes
+AUTOMOUNTED_CLUSTER=yes
+EULA=accept
+"""
+
+
 class EB_impi(IntelBase):
     """
     Support for installing Intel MPI library
@@ -64,8 +101,14 @@ class EB_impi(IntelBase):
         }
         return IntelBase.extra_options(extra_vars)
 
+    def __init__(self, *args, **kwargs):
+        """Initialisation of custom class variables for IMPI."""
+        super(EB_impi, self).__init__(*args, **kwargs)
+        self.loosever = LooseVersion(self.version)
+        self.shlib_ext = get_shared_lib_ext()
+
     def prepare_step(self, *args, **kwargs):
-        if LooseVersion(self.version) >= LooseVersion('2017.2.174'):
+        if self.loosever >= V_2017_2_174:
             kwargs['requires_runtime_license'] = False
             super(EB_impi, self).prepare_step(*args, **kwargs)
         else:
@@ -77,17 +120,15 @@ class EB_impi(IntelBase):
         - create silent cfg file
         - execute command
         """
-        impiver = LooseVersion(self.version)
-
-        if impiver >= LooseVersion('2021'):
+        if self.loosever >= V_2021:
             super(EB_impi, self).install_step()
 
-        elif impiver >= LooseVersion('4.0.1'):
+        elif self.loosever >= V_4_0_1:
             # impi starting from version 4.0.1.x uses standard installation procedure.
 
             silent_cfg_names_map = {}
 
-            if impiver < LooseVersion('4.1.1'):
+            if self.loosever < V_4_1_1:
                 # since impi v4.1.1, silent.cfg has been slightly changed to be 'more standard'
                 silent_cfg_names_map.update({
                     'activation_name': ACTIVATION_NAME_2012,
@@ -97,37 +138,21 @@ class EB_impi(IntelBase):
             super(EB_impi, self).install_step(silent_cfg_names_map=silent_cfg_names_map)
 
             # impi v4.1.1 and v5.0.1 installers create impi/<version> subdir, so stuff needs to be moved afterwards
-            if impiver == LooseVersion('4.1.1.036') or impiver >= LooseVersion('5.0.1.035'):
+            if self.loosever == V_4_1_1_036 or self.loosever >= V_5_0_1_035:
                 super(EB_impi, self).move_after_install()
         else:
             # impi up until version 4.0.0.x uses custom installation procedure.
-            silent = """[mpi]
-INSTALLDIR=%(ins)s
-LICENSEPATH=%(lic)s
-INSTALLMODE=NONRPM
-INSTALLUSER=NONROOT
-UPDATE_LD_SO_CONF=NO
-PROCEED_WITHOUT_PYTHON=yes
-AUTOMOUNTED_CLUSTER=yes
-EULA=accept
-[mpi-rt]
-INSTALLDIR=%(ins)s
-LICENSEPATH=%(lic)s
-INSTALLMODE=NONRPM
-INSTALLUSER=NONROOT
-UPDATE_LD_SO_CONF=NO
-PROCEED_WITHOUT_PYTHON=yes
-AUTOMOUNTED_CLUSTER=yes
-EULA=accept
-
-""" % {'lic': self.license_file, 'ins': self.installdir}
+            silent_cfg_vars = {'lic': self.license_file, 'ins': self.installdir}
+            silent = ''.join(SILENT_CFG_SECTION_TEMPLATE % dict(silent_cfg_vars, section=section)
+                             for section in ['mpi', 'mpi-rt']) + '\n'
 
             # already in correct directory
-            silentcfg = os.path.join(os.getcwd(), "silent.cfg")
+            cwd = os.getcwd()
+            silentcfg = os.path.join(cwd, "silent.cfg")
             write_file(silentcfg, silent)
             self.log.debug("Contents of %s: %s", silentcfg, silent)
 
-            tmpdir = os.path.join(os.getcwd(), self.version, 'mytmpdir')
+            tmpdir = os.path.join(cwd, self.version, 'mytmpdir')
             mkdir(tmpdir, parents=True)
 
             cmd = "./install.sh --tmp-dir=%s --silent=%s" % (tmpdir, silentcfg)
@@ -136,23 +161,26 @@ EULA=accept
         # recompile libfabric (if requested)
         # some Intel MPI versions (like 2019 update 6) no longer ship libfabric sources
         libfabric_path = os.path.join(self.installdir, 'libfabric')
-        if impiver >= LooseVersion('2019') and self.cfg['libfabric_rebuild']:
+        if self.loosever >= V_2019 and self.cfg['libfabric_rebuild']:
             if self.cfg['ofi_internal']:
                 libfabric_src_tgz_fn = 'src.tgz'
                 if os.path.exists(os.path.join(libfabric_path, libfabric_src_tgz_fn)):
                     change_dir(libfabric_path)
-                    srcdir = extract_file(libfabric_src_tgz_fn, os.getcwd(), change_into_dir=False)
+                    # use pigz for (multi-threaded) decompression if it is available, rather than gzip via 'tar xzf'
+                    extract_cmd = None
+                    if which('pigz', log_ok=False, log_error=False):
+                        extract_cmd = "pigz -dc %s | tar xf -"
+                    srcdir = extract_file(libfabric_src_tgz_fn, libfabric_path, cmd=extract_cmd, change_into_dir=False)
                     change_dir(srcdir)
                     libfabric_installpath = os.path.join(self.installdir, 'intel64', 'libfabric')
 
-                    make = 'make'
-                    if self.cfg['parallel']:
-                        make += ' -j %d' % self.cfg['parallel']
+                    # also run 'make install' in parallel, since it may (re)build stuff too
+                    make = 'make -j %d' % (self.cfg['parallel'] or 1)
 
                     cmds = [
                         './configure --prefix=%s %s' % (libfabric_installpath, self.cfg['libfabric_configopts']),
                         make,
-                        'make install'
+                        make + ' install',
                     ]
                     for cmd in cmds:
                         run_cmd(cmd, log_all=True, simple=True)
@@ -166,77 +194,120 @@ EULA=accept
         """Custom post install step for IMPI, fix broken env scripts after moving installed files."""
         super(EB_impi, self).post_install_step()
 
-        impiver = LooseVersion(self.version)
+        self.fix_install_paths()
 
-        if impiver >= LooseVersion('2021'):
+    def fix_install_paths(self):
+        """Fix paths in env scripts and compiler wrappers after moving installed files."""
+        if self.loosever >= V_2021:
             self.log.info("No post-install action for impi v%s", self.version)
 
-        elif impiver == LooseVersion('4.1.1.036') or impiver >= LooseVersion('5.0.1.035'):
-            if impiver >= LooseVersion('2018.0.128'):
+        elif self.loosever == V_4_1_1_036 or self.loosever >= V_5_0_1_035:
+            if self.loosever >= V_2018_0_128:
                 script_paths = [os.path.join('intel64', 'bin')]
             else:
                 script_paths = [os.path.join('intel64', 'bin'), os.path.join('mic', 'bin')]
-            # fix broken env scripts after the move
-            regex_subs = [(r"^setenv I_MPI_ROOT.*", r"setenv I_MPI_ROOT %s" % self.installdir)]
-            for script in [os.path.join(script_path, 'mpivars.csh') for script_path in script_paths]:
-                apply_regex_substitutions(os.path.join(self.installdir, script), regex_subs)
-            regex_subs = [(r"^(\s*)I_MPI_ROOT=[^;\n]*", r"\1I_MPI_ROOT=%s" % self.installdir)]
-            for script in [os.path.join(script_path, 'mpivars.sh') for script_path in script_paths]:
-                apply_regex_substitutions(os.path.join(self.installdir, script), regex_subs)
+            script_dirs = [os.path.join(self.installdir, script_path) for script_path in script_paths]
+
+            # fix broken env scripts after the move;
+            # each set of substitutions is applied to all relevant files in one go;
+            # no backup copies are made, so each env script is only written once (and no *.orig.eb files get installed)
+            regex_subs = [(MPIVARS_CSH_I_MPI_ROOT_REGEX, r"setenv I_MPI_ROOT %s" % self.installdir)]
+            self.fix_files([os.path.join(d, 'mpivars.csh') for d in script_dirs], regex_subs, backup=False)
+            regex_subs = [(MPIVARS_SH_I_MPI_ROOT_REGEX, r"\1I_MPI_ROOT=%s" % self.installdir)]
+            self.fix_files([os.path.join(d, 'mpivars.sh') for d in script_dirs], regex_subs, backup=False)
 
             # fix 'prefix=' in compiler wrapper scripts after moving installation (see install_step)
-            wrappers = ['mpif77', 'mpif90', 'mpigcc', 'mpigxx', 'mpiicc', 'mpiicpc', 'mpiifort']
-            regex_subs = [(r"^prefix=.*", r"prefix=%s" % self.installdir)]
-            for script_dir in script_paths:
-                for wrapper in wrappers:
-                    wrapper_path = os.path.join(self.installdir, script_dir, wrapper)
-                    if os.path.exists(wrapper_path):
-                        apply_regex_substitutions(wrapper_path, regex_subs)
+            # use a single directory listing per directory to determine which wrappers are there
+            wrapper_paths = []
+            for script_dir in script_dirs:
+                try:
+                    present = set(os.listdir(script_dir))
+                except OSError as err:
+                    self.log.debug("Failed to list contents of %s: %s", script_dir, err)
+                    present = set()
+                wrapper_paths.extend(os.path.join(script_dir, w) for w in COMPILER_WRAPPERS if w in present)
+            regex_subs = [(WRAPPER_PREFIX_REGEX, r"prefix=%s" % self.installdir)]
+            self.fix_files(wrapper_paths, regex_subs)
+
+    def fix_files(self, paths, regex_subs, backup='.orig.eb'):
+        """
+        Apply regex substitutions line per line to specified files (like apply_regex_substitutions does),
+        but only rewrite files that are actually changed, to avoid needlessly rewriting files that are already fixed
+        (for example when reinstalling).
+        """
+        if self.dry_run:
+            # only report which regex substitutions would be applied
+            if paths:
+                apply_regex_substitutions(paths, regex_subs, backup=backup)
+            return
+
+        non_utf8_paths = []
+        for path in paths:
+            try:
+                txt = read_file(path)
+            except UnicodeDecodeError as err:
+                # leave it up to apply_regex_substitutions to deal with non-UTF-8 characters
+                self.log.info("Failed to read %s in text mode (%s), so falling back to apply_regex_substitutions",
+                              path, err)
+                non_utf8_paths.append(path)
+                continue
+
+            lines = txt.split('\n')
+            for regex, subtxt in regex_subs:
+                lines = [regex.sub(subtxt, line) for line in lines]
+            new_txt = '\n'.join(lines)
+
+            if new_txt == txt:
+                self.log.info("No changes required for %s, so not applying regex substitutions", path)
+            else:
+                self.log.info("Applying following regex substitutions to %s: %s", path, regex_subs)
+                if backup:
+                    copy_file(path, path + backup)
+                write_file(path, new_txt)
+
+        if non_utf8_paths:
+            apply_regex_substitutions(non_utf8_paths, regex_subs, backup=backup)
 
     def sanity_check_step(self):
         """Custom sanity check paths for IMPI."""
 
-        impi_ver = LooseVersion(self.version)
-
         suff = '64'
         if self.cfg['m32']:
             suff = ''
 
         mpi_mods = ['mpi.mod']
-        if impi_ver > LooseVersion('4.0'):
+        if self.loosever > V_4_0:
             mpi_mods.extend(['mpi_base.mod', 'mpi_constants.mod', 'mpi_sizeofs.mod'])
 
-        if impi_ver >= LooseVersion('2021'):
+        if self.loosever >= V_2021:
             mpi_subdir = os.path.join('mpi', self.version)
             bin_dir = os.path.join(mpi_subdir, 'bin')
             include_dir = os.path.join(mpi_subdir, 'include')
             lib_dir = os.path.join(mpi_subdir, 'lib', 'release')
 
-        elif impi_ver >= LooseVersion('2019'):
+        elif self.loosever >= V_2019:
             bin_dir = os.path.join('intel64', 'bin')
             include_dir = os.path.join('intel64', 'include')
             lib_dir = os.path.join('intel64', 'lib', 'release')
         else:
-            bin_dir = 'bin%s' % suff
-            include_dir = 'include%s' % suff
-            lib_dir = 'lib%s' % suff
+            bin_dir = 'bin' + suff
+            include_dir = 'include' + suff
+            lib_dir = 'lib' + suff
             mpi_mods.extend(['i_malloc.h'])
 
-        shlib_ext = get_shared_lib_ext()
         custom_paths = {
-            'files': [os.path.join(bin_dir, 'mpi%s' % x) for x in ['icc', 'icpc', 'ifort']] +
-            [os.path.join(include_dir, 'mpi%s.h' % x) for x in ['cxx', 'f', '', 'o', 'of']] +
+            'files': [os.path.join(bin_dir, 'mpi' + x) for x in ('icc', 'icpc', 'ifort')] +
+            [os.path.join(include_dir, 'mpi' + x + '.h') for x in ('cxx', 'f', '', 'o', 'of')] +
             [os.path.join(include_dir, x) for x in mpi_mods] +
-            [os.path.join(lib_dir, 'libmpi.%s' % shlib_ext)] +
-            [os.path.join(lib_dir, 'libmpi.a')],
+            [os.path.join(lib_dir, 'libmpi.' + x) for x in (self.shlib_ext, 'a')],
             'dirs': [],
         }
 
         custom_commands = []
 
-        if impi_ver >= LooseVersion('2017'):
+        if self.loosever >= V_2017:
             # Add minimal test program to sanity checks
-            if impi_ver >= LooseVersion('2021'):
+            if self.loosever >= V_2021:
                 impi_testsrc = os.path.join(self.installdir, 'mpi', self.version, 'test', 'test.c')
             else:
                 impi_testsrc = os.path.join(self.installdir, 'test', 'test.c')
@@ -279,38 +350,38 @@ EULA=accept
         else:
             manpath = 'man'
 
-            impi_ver = LooseVersion(self.version)
-            if impi_ver >= LooseVersion('2021'):
+            if self.loosever >= V_2021:
                 mpi_subdir = os.path.join('mpi', self.version)
+                libfabric_dir = os.path.join(mpi_subdir, 'libfabric')
+                # when internal libfabric is used, its paths are included again at the end (so with highest priority)
+                ofi_dirs = [libfabric_dir] if self.cfg['ofi_internal'] else []
+
                 lib_dirs = [
                     os.path.join(mpi_subdir, 'lib'),
                     os.path.join(mpi_subdir, 'lib', 'release'),
-                    os.path.join(mpi_subdir, 'libfabric', 'lib'),
-                ]
+                    os.path.join(libfabric_dir, 'lib'),
+                ] + [os.path.join(x, 'lib') for x in ofi_dirs]
                 include_dirs = [os.path.join(mpi_subdir, 'include')]
                 path_dirs = [
                     os.path.join(mpi_subdir, 'bin'),
-                    os.path.join(mpi_subdir, 'libfabric', 'bin'),
-                ]
+                    os.path.join(libfabric_dir, 'bin'),
+                ] + [os.path.join(x, 'bin') for x in ofi_dirs]
                 manpath = os.path.join(mpi_subdir, 'man')
 
-                if self.cfg['ofi_internal']:
-                    libfabric_dir = os.path.join('mpi', self.version, 'libfabric')
-                    lib_dirs.append(os.path.join(libfabric_dir, 'lib'))
-                    path_dirs.append(os.path.join(libfabric_dir, 'bin'))
-                    guesses['FI_PROVIDER_PATH'] = [os.path.join(libfabric_dir, 'lib', 'prov')]
+            elif self.loosever >= V_2019:
+                libfabric_dir = os.path.join('intel64', 'libfabric')
+                ofi_dirs = [libfabric_dir] if self.cfg['ofi_internal'] else []
 
-            elif impi_ver >= LooseVersion('2019'):
                 # The "release" library is default in v2019. Give it precedence over intel64/lib.
                 # (remember paths are *prepended*, so the last path in the list has highest priority)
-                lib_dirs = [os.path.join('intel64', x) for x in ['lib', os.path.join('lib', 'release')]]
+                lib_dirs = [
+                    os.path.join('intel64', 'lib'),
+                    os.path.join('intel64', 'lib', 'release'),
+                ] + [os.path.join(x, 'lib') for x in ofi_dirs]
                 include_dirs = [os.path.join('intel64', 'include')]
-                path_dirs = [os.path.join('intel64', 'bin')]
-                if self.cfg['ofi_internal']:
-                    lib_dirs.append(os.path.join('intel64', 'libfabric', 'lib'))
-                    path_dirs.append(os.path.join('intel64', 'libfabric', 'bin'))
-                    guesses['FI_PROVIDER_PATH'] = [os.path.join('intel64', 'libfabric', 'lib', 'prov')]
+                path_dirs = [os.path.join('intel64', 'bin')] + [os.path.join(x, 'bin') for x in ofi_dirs]
             else:
+                ofi_dirs = []
                 lib_dirs = [os.path.join('lib', 'em64t'), 'lib64']
                 include_dirs = ['include64']
                 path_dirs = [os.path.join('bin', 'intel64'), 'bin64']
@@ -323,6 +394,8 @@ EULA=accept
                 'MANPATH': [manpath],
                 'CPATH': include_dirs,
             })
+            if ofi_dirs:
+                guesses['FI_PROVIDER_PATH'] = [os.path.join(x, 'lib', 'prov') for x in ofi_dirs]
 
         return guesses
 
@@ -43,6 +43,13 @@ from easybuild.tools.systemtools import get_shared_lib_ext
 class EB_wxPython(PythonPackage):
     """Support for installing the wxPython Python package."""
 
+    def __init__(self, *args, **kwargs):
+        """Initialisation of custom class variables for wxPython."""
+        super(EB_wxPython, self).__init__(*args, **kwargs)
+
+        # major/minor version, e.g. '3.0' for wxPython 3.0.2.0
+        self.majver = '.'.join(self.version.split('.', 2)[:2])
+
     def build_step(self):
         """Custom build step for wxPython."""
         if LooseVersion(self.version) >= LooseVersion("4"):
@@ -116,7 +123,7 @@ class EB_wxPython(PythonPackage):
 
     def sanity_check_step(self):
         """Custom sanity check for wxPython."""
-        majver = '.'.join(self.version.split('.')[:2])
+        majver = self.majver
         shlib_ext = get_shared_lib_ext()
         py_bins = ['crust', 'shell', 'wxrc']
         files = []
@@ -163,7 +170,7 @@ class EB_wxPython(PythonPackage):
 
         if LooseVersion(self.version) < LooseVersion("4"):
             # make sure that correct subdir is also included to $PYTHONPATH
-            majver = '.'.join(self.version.split('.')[:2])
-            txt += self.module_generator.prepend_paths('PYTHONPATH', os.path.join(self.pylibdir, 'wx-%s-gtk2' % majver))
+            wx_subdir = os.path.join(self.pylibdir, 'wx-%s-gtk2' % self.majver)
+            txt += self.module_generator.prepend_paths('PYTHONPATH', wx_subdir)
 
         return txt
@@ -29,19 +29,22 @@ Unit tests for specific easyblocks.
 """
 import copy
 import os
+import re
 import sys
 import tempfile
 from unittest import TestCase, TestLoader, TextTestRunner
 from test.easyblocks.module import cleanup
 
 import easybuild.tools.options as eboptions
+from easybuild.easyblocks.generic.intelbase import IntelBase
 from easybuild.easyblocks.generic.toolchain import Toolchain
+from easybuild.easyblocks.imkl import EB_imkl
 from easybuild.framework.easyblock import get_easyblock_instance
 from easybuild.framework.easyconfig.easyconfig import process_easyconfig
 from easybuild.tools import config
 from easybuild.tools.config import get_module_syntax
 from easybuild.tools.environment import modify_env
-from easybuild.tools.filetools import remove_dir, write_file
+from easybuild.tools.filetools import mkdir, read_file, remove_dir, symlink, write_file
 from easybuild.tools.modules import modules_tool
 from easybuild.tools.options import set_tmpdir
 from easybuild.tools.py2vs3 import StringIO
@@ -83,6 +86,143 @@ class EasyBlockSpecificTest(TestCase):
         """Return output captured from stdout until now."""
         return sys.stdout.getvalue()
 
+    def get_test_easyblock_instance(self, name, version):
+        """Create easyblock instance for specified software name and version, using a minimal easyconfig file."""
+        # initialize configuration
+        cleanup()
+        eb_go = eboptions.parse_options(args=['--installpath=%s' % self.tmpdir])
+        config.init(eb_go.options, eb_go.get_options_by_section('config'))
+        config.init_build_options(build_options={'valid_module_classes': config.module_classes()})
+        set_tmpdir()
+        del eb_go
+
+        test_ec_path = os.path.join(self.tmpdir, '%s-%s.eb' % (name, version))
+        test_ec_txt = '\n'.join([
+            "name = '%s'" % name,
+            "version = '%s'" % version,
+            "homepage = 'https://example.com'",
+            "description = 'just a test'",
+            "toolchain = SYSTEM",
+        ])
+        write_file(test_ec_path, test_ec_txt)
+
+        return get_easyblock_instance(process_easyconfig(test_ec_path)[0])
+
+    def test_imkl_filter_listed_files(self):
+        """Test filter_listed_files method of imkl easyblock."""
+        imkl = self.get_test_easyblock_instance('imkl', '2021.1.1')
+        self.assertTrue(isinstance(imkl, EB_imkl))
+
+        lib_subdir = os.path.join('mkl', '2021.1.1', 'lib', 'intel64')
+        lib_dir = os.path.join(imkl.installdir, lib_subdir)
+        write_file(os.path.join(lib_dir, 'present'), '')
+        symlink(os.path.join(lib_dir, 'present'), os.path.join(lib_dir, 'symlink'))
+        symlink(os.path.join(lib_dir, 'nosuchfile'), os.path.join(lib_dir, 'dangling'))
+        mkdir(os.path.join(lib_dir, 'subdir'))
+
+        paths = [os.path.join(lib_subdir, x) for x in ['present', 'missing', 'symlink', 'dangling', 'subdir']]
+        paths.append(os.path.join('nosuchdir', 'present'))
+
+        res = imkl.filter_listed_files(paths)
+        if hasattr(os, 'scandir'):
+            # only regular files that are present are filtered out, everything else must still be checked
+            self.assertEqual(res, paths[1:])
+        else:
+            # no filtering when os.scandir is not available (Python 2)
+            self.assertEqual(res, paths)
+
+    def test_impi_fix_install_paths(self):
+        """Test fixing of paths in env scripts and compiler wrappers by impi easyblock."""
+        impi = self.get_test_easyblock_instance('impi', '2019.7.217')
+
+        bin_dir = os.path.join(impi.installdir, 'intel64', 'bin')
+        write_file(os.path.join(bin_dir, 'mpivars.csh'), "setenv I_MPI_ROOT /old/impi\n")
+        # already fixed
+        write_file(os.path.join(bin_dir, 'mpivars.sh'), "  I_MPI_ROOT=%s; export I_MPI_ROOT\n" % impi.installdir)
+        write_file(os.path.join(bin_dir, 'mpiifort'), "#!/bin/sh\nprefix=%s\n" % impi.installdir)
+        # compiler wrapper that includes a non-UTF-8 character
+        with open(os.path.join(bin_dir, 'mpiicc'), 'wb') as fp:
+            fp.write(b"#!/bin/sh\n# \xe9\nprefix=/old/impi\n")
+
+        impi.fix_install_paths()
+
+        self.assertEqual(read_file(os.path.join(bin_dir, 'mpivars.csh')), "setenv I_MPI_ROOT %s\n" % impi.installdir)
+        regex = re.compile('^prefix=%s$' % re.escape(impi.installdir), re.M)
+        for wrapper in ['mpiicc', 'mpiifort']:
+            txt = read_file(os.path.join(bin_dir, wrapper), mode='rb').decode('utf-8', 'replace')
+            self.assertTrue(regex.search(txt), "Pattern '%s' not found in: %s" % (regex.pattern, txt))
+
+        # no backups are made for env scripts, files that are already fixed are left untouched
+        self.assertTrue(os.path.exists(os.path.join(bin_dir, 'mpiicc.orig.eb')))
+        for fn in ['mpivars.csh.orig.eb', 'mpivars.sh.orig.eb', 'mpiifort.orig.eb']:
+            self.assertFalse(os.path.exists(os.path.join(bin_dir, fn)))
+
+    def test_impi_sanity_check_paths(self):
+        """Test sanity check paths for impi easyblock, for an installation where all expected files are present."""
+        # use impi version for which no sanity check commands are used (which require a working impi installation)
+        impi = self.get_test_easyblock_instance('impi', '5.1.3.181')
+
+        # intercept sanity check paths & commands that are passed down to generic sanity check
+        sanity_check_args = []
+
+        def intercept_sanity_check_step(self, custom_paths=None, custom_commands=None):
+            """Store custom sanity check paths & commands."""
+            sanity_check_args.append((custom_paths, custom_commands))
+
+        orig_sanity_check_step = IntelBase.sanity_check_step
+        IntelBase.sanity_check_step = intercept_sanity_check_step
+        try:
+            impi.sanity_check_step()
+            custom_paths = sanity_check_args[-1][0]
+            self.assertTrue(custom_paths['files'])
+
+            for path in custom_paths['files']:
+                write_file(os.path.join(impi.installdir, path), '')
+
+            impi.sanity_check_step()
+        finally:
+            IntelBase.sanity_check_step = orig_sanity_check_step
+
+        # all files are still checked, and sanity check paths are accepted by generic sanity check
+        custom_paths, custom_commands = sanity_check_args[-1]
+        self.assertEqual(custom_paths, sanity_check_args[0][0])
+        paths, _, _ = impi._sanity_check_step_common(custom_paths, custom_commands)
+        self.assertEqual(paths['files'], custom_paths['files'])
+
+    def test_imkl_interface_lib_names(self):
+        """Test whether names of MKL interface libraries that are built match sanity check paths for imkl easyblock."""
+        for version in ['11.3.3.210', '2021.1.1']:
+            for cdftlibs in [[], ['fftw2x_cdft', 'fftw3x_cdft']]:
+                imkl = self.get_test_easyblock_instance('imkl', version)
+                imkl.cfg['interfaces'] = True
+                imkl.cdftlibs = cdftlibs
+                imkl.interfaces_comp_fam = 'gnu'
+
+                # intercept sanity check paths that are passed down to generic sanity check
+                sanity_check_paths = []
+
+                def intercept_sanity_check_step(self, custom_paths=None, custom_commands=None):
+                    """Store custom sanity check paths."""
+                    sanity_check_paths.append(custom_paths)
+
+                orig_sanity_check_step = IntelBase.sanity_check_step
+                IntelBase.sanity_check_step = intercept_sanity_check_step
+                try:
+                    imkl.sanity_check_step()
+                finally:
+                    IntelBase.sanity_check_step = orig_sanity_check_step
+
+                fftw_libs = [os.path.basename(path) for path in sanity_check_paths[0]['files']]
+                fftw_libs = sorted(x for x in fftw_libs if x.startswith('libfftw'))
+
+                lib_names = []
+                for (lib, _, variants) in imkl.get_interface_builds():
+                    lib_names.extend(imkl.interface_lib_name(lib, *variant) for variant in variants)
+
+                self.assertEqual(len(lib_names), len(set(lib_names)))
+                self.assertEqual(sorted(lib_names), fftw_libs)
+                self.assertEqual(any('cdft' in x for x in fftw_libs), bool(cdftlibs))
+
     def test_toolchain_external_modules(self):
         """Test use of Toolchain easyblock with external modules."""
 